@@ -14,11 +14,18 @@ from linebot.v3.messaging.models import (
 )
 from linebot.v3.messaging.api import MessagingApi
 import sqlite3
+import atexit
+import json
+import queue
+import threading
+import time
 import os
 from datetime import datetime
 from dotenv import load_dotenv
-from contextlib import contextmanager
-import requests
+from contextlib import ExitStack
+from concurrent.futures import ThreadPoolExecutor
+from db import DATABASE_PATH, get_db_connection, pool_stats
+from gold import GOLD_RE, get_gold_price, format_gold_message
 
 # Load environment variables
 load_dotenv()
@@ -41,51 +48,18 @@ api_client = ApiClient(configuration)
 messaging_api = MessagingApi(api_client)
 handler = WebhookHandler(LINE_CHANNEL_SECRET)
 
-def get_gold_price():
-    """Fetch and format gold price data"""
-    url = "https://karndiy.pythonanywhere.com/goldjsonv2"
-    try:
-        response = requests.get(url)
-        if response.status_code == 200:
-            data = response.json()
-            if data and len(data) > 0:
-                latest = data[0]
-                return {
-                    "asdate": latest["asdate"],
-                    "blbuy": latest["blbuy"],
-                    "blsell": latest["blsell"],
-                    "diff": latest["diff"]
-                }
-    except Exception as e:
-        print(f"Error fetching gold price: {e}")
-    return None
+MESSAGES_PAGE_SIZE = 1000
 
-def format_gold_message(gold_data):
-    """Format gold price data into a readable message"""
-    if not gold_data:
-        return "ไม่สามารถดึงข้อมูลราคาทองได้ในขณะนี้"
-    
-    message = (
-        f"ราคาทองคำล่าสุด\n"
-        f"วันที่: {gold_data['asdate']}\n"
-        f"ราคารับซื้อ: {gold_data['blbuy']} บาท\n"
-        f"ราคาขาย: {gold_data['blsell']} บาท\n"
-        f"ส่วนต่าง: {gold_data['diff']} บาท"
-    )
-    return message
-
-# Database connection context manager
-@contextmanager
-def get_db_connection():
-    conn = sqlite3.connect('line_oa.db')
-    try:
-        yield conn
-    finally:
-        conn.close()
+# Statements reused verbatim so sqlite3's per-connection statement cache hits
+SQL_UPSERT_USER = 'INSERT OR IGNORE INTO users (user_id, display_name, created_at) VALUES (?, ?, ?)'
+SQL_UPDATE_DISPLAY_NAME = 'UPDATE users SET display_name = ? WHERE user_id = ?'
+SQL_INSERT_MESSAGE = 'INSERT INTO messages (user_id, message, created_at) VALUES (?, ?, ?)'
+SQL_SELECT_MESSAGES = 'SELECT * FROM messages WHERE user_id = ? ORDER BY created_at DESC, id DESC LIMIT ? OFFSET ?'
 
 # Database initialization
 def init_db():
-    with get_db_connection() as conn:
+    conn = sqlite3.connect(DATABASE_PATH)
+    try:
         c = conn.cursor()
         c.execute('''
             CREATE TABLE IF NOT EXISTS users (
@@ -103,11 +77,152 @@ def init_db():
                 FOREIGN KEY (user_id) REFERENCES users (user_id)
             )
         ''')
+        c.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'idx_messages_user_created'")
+        index_exists = c.fetchone() is not None
+        c.execute('CREATE INDEX IF NOT EXISTS idx_messages_user_created ON messages (user_id, created_at DESC)')
         conn.commit()
+        # Refresh planner statistics once, when the index is first created, so it is picked up
+        if not index_exists:
+            c.execute('ANALYZE')
+    finally:
+        conn.close()
 
 # Initialize database
 init_db()
 
+# Incoming messages are written in batches off the webhook path
+MESSAGE_BATCH_SIZE = 256
+MESSAGE_BATCH_WAIT = 0.05
+MESSAGE_QUEUE_SIZE = 10000
+MESSAGE_QUEUE_TIMEOUT = 1  # seconds to wait for room before writing inline
+MESSAGE_RETRY_DELAY = 0.5  # seconds, doubled after each failed attempt
+MESSAGE_RETRY_MAX_DELAY = 30
+MESSAGE_FLUSH_TIMEOUT = 10  # seconds to wait for queued messages at exit
+message_queue = queue.Queue(maxsize=MESSAGE_QUEUE_SIZE)
+
+# Queued by flush_messages to stop the writer once everything before it is written
+_WRITER_STOP = object()
+
+# Workers for LINE profile lookups of newly seen users
+PROFILE_POOL = ThreadPoolExecutor(max_workers=4)
+
+def drain_message_queue():
+    """Block for one queued message, then collect more until the batch is full or the wait expires"""
+    batch = [message_queue.get()]
+    deadline = time.monotonic() + MESSAGE_BATCH_WAIT
+    while len(batch) < MESSAGE_BATCH_SIZE:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        try:
+            batch.append(message_queue.get(timeout=remaining))
+        except queue.Empty:
+            break
+    return batch
+
+def default_display_name(source_type, user_id):
+    return f"{source_type.capitalize()} {user_id}"
+
+def update_profile_name(user_id):
+    """Replace a newly seen user's placeholder display name with their LINE profile name"""
+    try:
+        profile = messaging_api.get_profile(user_id)
+        with get_db_connection(write=True) as conn:
+            conn.execute(SQL_UPDATE_DISPLAY_NAME, (profile.display_name, user_id))
+    except Exception as e:
+        print(f"Error updating profile for {user_id}: {e}")
+
+def write_batch(batch):
+    """Write queued users and messages in a single transaction"""
+    # One timestamp per batch, taken at write time; same text format the sqlite3
+    # datetime adapter produced. Readers break ties on id, which follows arrival order
+    now = datetime.now().isoformat(sep=' ')
+    messages = [(user_id, message, now) for user_id, _, message in batch]
+    with get_db_connection(write=True) as conn:
+        new_users = []
+        conn.execute('BEGIN')
+        try:
+            # Each sender is upserted once per batch, however many messages they sent
+            senders = {user_id: source_type for user_id, source_type, _ in batch}
+            for user_id, source_type in senders.items():
+                c = conn.execute(SQL_UPSERT_USER,
+                                 (user_id, default_display_name(source_type, user_id), now))
+                # Only look up profiles for users we have not seen before
+                if c.rowcount == 1 and source_type == "user":
+                    new_users.append(user_id)
+            conn.executemany(SQL_INSERT_MESSAGE, messages)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+    # Profile lookups go over the network, so they run off the writer thread
+    for user_id in new_users:
+        PROFILE_POOL.submit(update_profile_name, user_id)
+
+def write_messages():
+    """Flush queued users and messages, one transaction per batch.
+
+    Transient failures (pool timeout, locked database) are retried with
+    backoff until the batch is written; other errors drop the batch.
+    """
+    while True:
+        batch = drain_message_queue()
+        stopping = any(item is _WRITER_STOP for item in batch)
+        batch = [item for item in batch if item is not _WRITER_STOP]
+        delay = MESSAGE_RETRY_DELAY
+        while batch:
+            try:
+                write_batch(batch)
+                break
+            except (queue.Empty, sqlite3.OperationalError) as e:
+                print(f"Error writing {len(batch)} messages, retrying in {delay}s: {e}")
+                time.sleep(delay)
+                delay = min(delay * 2, MESSAGE_RETRY_MAX_DELAY)
+            except Exception as e:
+                print(f"Error writing messages, dropping {len(batch)}: {e}")
+                break
+        if stopping:
+            return
+
+_writer_pid = None
+_writer_thread = None
+_writer_lock = threading.Lock()
+
+def start_writer():
+    """Start this process's background writer thread on first use"""
+    global _writer_pid, _writer_thread
+    if _writer_pid == os.getpid():
+        return
+    with _writer_lock:
+        if _writer_pid == os.getpid():
+            return
+        _writer_thread = threading.Thread(target=write_messages, daemon=True)
+        _writer_thread.start()
+        _writer_pid = os.getpid()
+
+def queue_message(user_id, source_type, message_text):
+    """Hand a message to this process's background writer"""
+    start_writer()
+    item = (user_id, source_type, message_text)
+    try:
+        message_queue.put(item, timeout=MESSAGE_QUEUE_TIMEOUT)
+    except queue.Full:
+        # The writer is far behind; fall back to writing this message inline
+        write_batch([item])
+
+@atexit.register
+def flush_messages():
+    """Let this process's writer finish everything still queued before exiting"""
+    if _writer_pid != os.getpid():
+        return
+    try:
+        message_queue.put(_WRITER_STOP, timeout=MESSAGE_FLUSH_TIMEOUT)
+    except queue.Full:
+        pass
+    _writer_thread.join(MESSAGE_FLUSH_TIMEOUT)
+    if _writer_thread.is_alive():
+        print(f"Writer did not finish at exit; about {message_queue.qsize()} messages unwritten")
+
 def handle_webhook(body, signature):
     """Common webhook handling logic for both /callback and /webhook endpoints"""
     try:
@@ -150,39 +265,13 @@ def handle_message(event):
         else:
             return
 
-        message_text = event.message.text.lower()
-        
-        # Store user and message in database
-        with get_db_connection() as conn:
-            c = conn.cursor()
-            
-            # Check if user exists
-            c.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
-            user = c.fetchone()
-            
-            if not user:
-                try:
-                    # Get user profile (only for user messages)
-                    if source.type == "user":
-                        profile = messaging_api.get_profile(user_id)
-                        display_name = profile.display_name
-                    else:
-                        display_name = f"{source.type.capitalize()} {user_id}"
-                        
-                    c.execute('INSERT INTO users (user_id, display_name, created_at) VALUES (?, ?, ?)',
-                             (user_id, display_name, datetime.now()))
-                except Exception as e:
-                    print(f"Error getting profile: {e}")
-                    display_name = f"User {user_id}"
-            
-            # Store message
-            c.execute('INSERT INTO messages (user_id, message, created_at) VALUES (?, ?, ?)',
-                     (user_id, message_text, datetime.now()))
-            
-            conn.commit()
+        message_text = event.message.text
         
+        # Queue the message for the background writer
+        queue_message(user_id, source.type, message_text)
+
         # Handle gold price request
-        if "gold" in message_text or "ทอง" in message_text:
+        if GOLD_RE.search(message_text):
             gold_data = get_gold_price()
             reply_text = format_gold_message(gold_data)
         else:
@@ -225,21 +314,43 @@ def get_users():
 
 @app.route("/messages/<user_id>", methods=['GET'])
 def get_user_messages(user_id):
+    offset = max(request.args.get('offset', 0, type=int), 0)
+
+    # Borrow the connection and run the query up front so failures still return a 500;
+    # the connection goes back to the pool when the response is closed
+    stack = ExitStack()
     try:
-        with get_db_connection() as conn:
-            c = conn.cursor()
-            c.execute('SELECT * FROM messages WHERE user_id = ? ORDER BY created_at DESC', (user_id,))
-            messages = c.fetchall()
-            
-            return jsonify([{
+        conn = stack.enter_context(get_db_connection())
+        c = conn.cursor()
+        # Close the cursor (ending its read) before the connection goes back to the pool
+        stack.callback(c.close)
+        c.execute(SQL_SELECT_MESSAGES, (user_id, MESSAGES_PAGE_SIZE, offset))
+    except Exception as e:
+        stack.close()
+        print(f"Error getting messages: {e}")
+        return jsonify({"error": "Internal server error"}), 500
+
+    def generate():
+        # Rows are serialized straight off the cursor instead of being fetched into a list
+        yield '['
+        for i, msg in enumerate(c):
+            if i:
+                yield ','
+            yield json.dumps({
                 "id": msg[0],
                 "user_id": msg[1],
                 "message": msg[2],
                 "created_at": msg[3]
-            } for msg in messages])
-    except Exception as e:
-        print(f"Error getting messages: {e}")
-        return jsonify({"error": "Internal server error"}), 500
+            })
+        yield ']'
+
+    response = app.response_class(generate(), mimetype='application/json')
+    response.call_on_close(stack.close)
+    return response
+
+@app.route("/pool-health", methods=['GET'])
+def pool_health():
+    return jsonify(pool_stats())
 
 @app.route("/info", methods=['GET'])
 def get_bot_info():
@@ -255,4 +366,4 @@ def index():
     return "Hello World"
 
 if __name__ == "__main__":
-    app.run(debug=True, port=5000)
+    app.run(port=5000)
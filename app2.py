@@ -1,14 +1,16 @@
-import requests
-import schedule
-import time
 from flask import Flask, request, jsonify
 from linebot import LineBotApi, WebhookHandler
 from linebot.exceptions import InvalidSignatureError
 from linebot.models import MessageEvent, TextMessage, TextSendMessage
 from dotenv import load_dotenv
 import os
+import re
 from datetime import datetime
 import threading
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from db import DATABASE_PATH, get_db_connection
+from gold import GOLD_RE, get_gold_price, format_gold_message
 
 # Load environment variables
 load_dotenv()
@@ -25,81 +27,102 @@ LINE_USER_ID = os.getenv('LINE_USER_ID')
 line_bot_api = LineBotApi(LINE_CHANNEL_ACCESS_TOKEN)
 handler = WebhookHandler(LINE_CHANNEL_SECRET)
 
+# Keywords for unsubscribing
+CANCEL_RE = re.compile(r'ยกเลิก|unsubscribe', re.IGNORECASE)
+
 # Global variables for price tracking
 last_price = None
-subscribers = set()
 
-def get_gold_price():
-    """Fetch and format gold price data"""
-    url = "https://karndiy.pythonanywhere.com/goldjsonv2"
+# Database initialization
+def init_db():
+    conn = sqlite3.connect(DATABASE_PATH)
+    try:
+        c = conn.cursor()
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS subscribers (
+                user_id TEXT PRIMARY KEY,
+                subscribed_at TIMESTAMP
+            )
+        ''')
+        conn.commit()
+    finally:
+        conn.close()
+
+# Initialize database
+init_db()
+
+# Price check scheduling
+PRICE_CHECK_INTERVAL = 5 * 60  # seconds
+scheduler_stop = threading.Event()
+
+# Workers for fanning out subscriber notifications
+PUSH_POOL = ThreadPoolExecutor(max_workers=32)
+MULTICAST_LIMIT = 500  # LINE accepts at most 500 recipients per multicast
+
+PRICE_CHANGE_TEMPLATE = (
+    "🔔 แจ้งเตือนการเปลี่ยนแปลงราคาทอง\n"
+    "ราคารับซื้อ: {blbuy:,.2f} บาท ({buy_sign}{buy_change:,.2f} บาท)\n"
+    "ราคาขาย: {blsell:,.2f} บาท ({sell_sign}{sell_change:,.2f} บาท)\n"
+    "อัพเดทเมื่อ: {time}"
+)
+
+def safe_multicast(user_ids, text):
+    """Multicast a text message, logging instead of raising on failure"""
     try:
-        response = requests.get(url)
-        if response.status_code == 200:
-            data = response.json()
-            if data and len(data) > 0:
-                latest = data[0]
-                return {
-                    "asdate": latest["asdate"],
-                    "blbuy": latest["blbuy"],
-                    "blsell": latest["blsell"],
-                    "diff": latest["diff"]
-                }
+        line_bot_api.multicast(user_ids, TextSendMessage(text=text))
     except Exception as e:
-        print(f"Error fetching gold price: {e}")
-    return None
-
-def format_gold_message(gold_data):
-    """Format gold price data into a readable message"""
-    if not gold_data:
-        return "ไม่สามารถดึงข้อมูลราคาทองได้ในขณะนี้"
-    
-    message = (
-        f"ราคาทองคำล่าสุด\n"
-        f"วันที่: {gold_data['asdate']}\n"
-        f"ราคารับซื้อ: {gold_data['blbuy']} บาท\n"
-        f"ราคาขาย: {gold_data['blsell']} บาท\n"
-        f"ส่วนต่าง: {gold_data['diff']} บาท"
-    )
-    return message
+        print(f"Error sending notification to {len(user_ids)} subscribers: {e}")
 
 def check_price_changes():
     """Check for gold price changes and notify subscribers"""
     global last_price
     
+    # Read the shared slot once; it is only replaced by the single assignment below
+    previous_price = last_price
     current_price = get_gold_price()
-    if current_price and last_price:
+    if current_price and previous_price:
         # Check if price has changed
-        if (current_price['blbuy'] != last_price['blbuy'] or 
-            current_price['blsell'] != last_price['blsell']):
+        if (current_price.blbuy != previous_price.blbuy or 
+            current_price.blsell != previous_price.blsell):
             
             # Calculate price changes
-            buy_change = current_price['blbuy'] - last_price['blbuy']
-            sell_change = current_price['blsell'] - last_price['blsell']
+            buy_change = current_price.blbuy - previous_price.blbuy
+            sell_change = current_price.blsell - previous_price.blsell
             
             # Format change message
-            change_message = (
-                f"🔔 แจ้งเตือนการเปลี่ยนแปลงราคาทอง\n"
-                f"ราคารับซื้อ: {current_price['blbuy']} บาท "
-                f"({'+' if buy_change > 0 else ''}{buy_change} บาท)\n"
-                f"ราคาขาย: {current_price['blsell']} บาท "
-                f"({'+' if sell_change > 0 else ''}{sell_change} บาท)\n"
-                f"อัพเดทเมื่อ: {datetime.now().strftime('%H:%M:%S')}"
+            change_message = PRICE_CHANGE_TEMPLATE.format(
+                blbuy=current_price.blbuy,
+                buy_sign=('', '+')[buy_change > 0],
+                buy_change=buy_change,
+                blsell=current_price.blsell,
+                sell_sign=('', '+')[sell_change > 0],
+                sell_change=sell_change,
+                time=datetime.now().strftime('%H:%M:%S')
             )
             
-            # Notify all subscribers
-            for user_id in subscribers:
-                try:
-                    line_bot_api.push_message(user_id, TextSendMessage(text=change_message))
-                except Exception as e:
-                    print(f"Error sending notification to {user_id}: {e}")
+            # Notify all subscribers, MULTICAST_LIMIT recipients per request
+            with get_db_connection() as conn:
+                c = conn.cursor()
+                c.execute('SELECT user_id FROM subscribers')
+                chunks = []
+                while True:
+                    rows = c.fetchmany(MULTICAST_LIMIT)
+                    if not rows:
+                        break
+                    chunks.append([row[0] for row in rows])
+            list(PUSH_POOL.map(lambda chunk: safe_multicast(chunk, change_message), chunks))
     
-    last_price = current_price
+    # Keep the last good quote if this fetch failed
+    if current_price:
+        last_price = current_price
 
 def run_schedule():
-    """Run the scheduler in a separate thread"""
-    while True:
-        schedule.run_pending()
-        time.sleep(1)
+    """Run check_price_changes every PRICE_CHECK_INTERVAL seconds until stopped"""
+    while not scheduler_stop.wait(PRICE_CHECK_INTERVAL):
+        try:
+            check_price_changes()
+        except Exception as e:
+            print(f"Error checking price changes: {e}")
 
 
 # Webhook Route
@@ -123,23 +146,26 @@ def webhook():
 # Handle Incoming Messages
 @handler.add(MessageEvent, message=TextMessage)
 def handle_text_message(event):
-    user_message = event.message.text.lower()
+    user_message = event.message.text
     user_id = event.source.user_id
 
-    if "gold" in user_message or "ทอง" in user_message:
+    if GOLD_RE.search(user_message):
         gold_data = get_gold_price()
         reply_text = format_gold_message(gold_data)
         line_bot_api.reply_message(event.reply_token, TextSendMessage(text=reply_text))
         
         # Add user to subscribers
-        subscribers.add(user_id)
+        with get_db_connection(write=True) as conn:
+            conn.execute('INSERT OR IGNORE INTO subscribers (user_id, subscribed_at) VALUES (?, ?)',
+                         (user_id, datetime.now().isoformat(sep=' ')))
         line_bot_api.push_message(user_id, TextSendMessage(
             text="คุณได้ลงทะเบียนรับการแจ้งเตือนราคาทองแล้ว\n"
                  "ระบบจะแจ้งเตือนเมื่อมีการเปลี่ยนแปลงราคา"
         ))
-    elif "ยกเลิก" in user_message or "unsubscribe" in user_message:
-        if user_id in subscribers:
-            subscribers.remove(user_id)
+    elif CANCEL_RE.search(user_message):
+        with get_db_connection(write=True) as conn:
+            c = conn.execute('DELETE FROM subscribers WHERE user_id = ?', (user_id,))
+        if c.rowcount:
             line_bot_api.reply_message(event.reply_token, TextSendMessage(
                 text="คุณได้ยกเลิกการรับการแจ้งเตือนราคาทองแล้ว"
             ))
@@ -150,18 +176,19 @@ def handle_text_message(event):
     else:
         line_bot_api.reply_message(event.reply_token, TextSendMessage(text=f"ได้รับข้อความ: {user_message}"))
 
-# Start Flask app
-if __name__ == "__main__":
-    # Initialize last price
+def start_scheduler():
+    """Prime last_price and start the price check thread"""
+    global last_price
     last_price = get_gold_price()
-    
-    # Schedule price check every 5 minutes
-    schedule.every(5).minutes.do(check_price_changes)
-    
-    # Start scheduler in a separate thread
     scheduler_thread = threading.Thread(target=run_schedule)
     scheduler_thread.daemon = True
     scheduler_thread.start()
+    return scheduler_thread
+
+# Start Flask app
+if __name__ == "__main__":
+    # Start scheduler in a separate thread
+    start_scheduler()
     
     # Start Flask app
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    app.run(host='0.0.0.0', port=5000)
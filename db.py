@@ -0,0 +1,134 @@
+"""Pooled SQLite connections shared by app.py and app2.py"""
+import os
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+DATABASE_PATH = 'line_oa.db'
+POOL_SIZE = 8  # default, overridden by DB_POOL_SIZE (minimum 2)
+POOL_TIMEOUT = 5
+STATEMENT_CACHE_SIZE = 256
+
+# Applied to every pooled connection before it is handed out
+CONNECTION_PRAGMAS = (
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA cache_size=-64000',
+    'PRAGMA mmap_size=268435456',
+    'PRAGMA busy_timeout=5000',
+)
+
+class ConnectionPool:
+    """Bounded pool of long-lived SQLite connections"""
+
+    def __init__(self, database, size=POOL_SIZE):
+        self.database = database
+        self.size = size
+        self._pool = queue.Queue(maxsize=size)
+        for _ in range(size):
+            self._pool.put(self._connect())
+
+    def _connect(self):
+        conn = sqlite3.connect(self.database, check_same_thread=False, isolation_level=None,
+                               cached_statements=STATEMENT_CACHE_SIZE)
+        for pragma in CONNECTION_PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def get(self, timeout=POOL_TIMEOUT):
+        conn = self._pool.get(timeout=timeout)
+        if conn is None:
+            # Slot left empty by a failed reconnect; try again now
+            try:
+                conn = self._connect()
+            except BaseException:
+                self._pool.put(None)
+                raise
+        return conn
+
+    def put(self, conn):
+        self._pool.put(conn)
+
+    def release(self, conn):
+        """Return a connection after an error, replacing it only if it no longer works"""
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            conn.execute('SELECT 1')
+        except sqlite3.Error:
+            self.discard(conn)
+        else:
+            self._pool.put(conn)
+
+    def discard(self, conn):
+        """Close a broken connection and replace it with a fresh one"""
+        try:
+            conn.close()
+        except Exception:
+            pass
+        try:
+            conn = self._connect()
+        except sqlite3.Error as e:
+            print(f"Error reconnecting to database: {e}")
+            conn = None
+        # Always refill the slot so the pool never shrinks
+        self._pool.put(conn)
+
+    def available(self):
+        return self._pool.qsize()
+
+    def stats(self):
+        available = self.available()
+        return {
+            "pool_size": self.size,
+            "available": available,
+            "in_use": self.size - available
+        }
+
+# Connection pools (one writer, N-1 readers), created per process by init_pools
+writer_pool = None
+reader_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+def init_pools():
+    """Create this process's connection pools on first use.
+
+    Keyed on the process id so each WSGI worker opens its own connections
+    after forking instead of sharing the parent's.
+    """
+    global writer_pool, reader_pool, _pool_pid
+    if _pool_pid == os.getpid():
+        return
+    with _pool_lock:
+        if _pool_pid == os.getpid():
+            return
+        # At least one writer and one reader; a zero-size Queue would be unbounded and empty
+        size = max(int(os.getenv('DB_POOL_SIZE', POOL_SIZE)), 2)
+        writer_pool = ConnectionPool(DATABASE_PATH, size=1)
+        reader_pool = ConnectionPool(DATABASE_PATH, size=size - 1)
+        _pool_pid = os.getpid()
+
+def pool_stats():
+    init_pools()
+    return {
+        "writer": writer_pool.stats(),
+        "readers": reader_pool.stats()
+    }
+
+# Database connection context manager
+@contextmanager
+def get_db_connection(write=False):
+    """Borrow a pooled connection; writes go through the single writer connection"""
+    init_pools()
+    pool = writer_pool if write else reader_pool
+    conn = pool.get()
+    try:
+        yield conn
+    except BaseException:
+        pool.release(conn)
+        raise
+    else:
+        pool.put(conn)
@@ -0,0 +1,101 @@
+"""Gold price lookup and formatting shared by app.py and app2.py"""
+import re
+import threading
+import time
+from collections import namedtuple
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Keywords that trigger a gold price reply
+GOLD_RE = re.compile(r'gold|ทอง', re.IGNORECASE)
+
+GOLD_PRICE_URL = "https://karndiy.pythonanywhere.com/goldjsonv2"
+GOLD_PRICE_TTL = 30  # seconds
+GOLD_PRICE_FAILURE_TTL = 5  # seconds
+GOLD_PRICE_TIMEOUT = (2, 4)  # (connect, read) seconds; only connect failures are retried
+
+# Shared HTTP session keeps the upstream connection alive between fetches
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=16,
+    # read=0: a read timeout is not retried, so a stalled upstream gives up after 4 s
+    max_retries=Retry(total=2, read=0, backoff_factor=0.2)
+))
+
+# Latest upstream quote with prices already converted to floats
+GoldTick = namedtuple('GoldTick', 'asdate blbuy blsell diff')
+
+FORMAT_TEMPLATE = (
+    "ราคาทองคำล่าสุด\n"
+    "วันที่: {0.asdate}\n"
+    "ราคารับซื้อ: {0.blbuy:,.2f} บาท\n"
+    "ราคาขาย: {0.blsell:,.2f} บาท\n"
+    "ส่วนต่าง: {0.diff:,.2f} บาท"
+)
+_format_gold = FORMAT_TEMPLATE.format
+GOLD_ERROR_MESSAGE = "ไม่สามารถดึงข้อมูลราคาทองได้ในขณะนี้"
+
+_gold_cache = {"expires": None, "val": None, "refreshing": False}
+_gold_cond = threading.Condition()
+
+def parse_price(value):
+    """Convert an upstream price, numeric or a string with thousands separators, to float"""
+    return float(str(value).replace(',', ''))
+
+def fetch_gold_price():
+    """Fetch the latest upstream quote and parse it into a GoldTick"""
+    try:
+        response = SESSION.get(GOLD_PRICE_URL, timeout=GOLD_PRICE_TIMEOUT)
+        if response.status_code == 200:
+            data = response.json()
+            if data and len(data) > 0:
+                latest = data[0]
+                return GoldTick(
+                    latest["asdate"],
+                    parse_price(latest["blbuy"]),
+                    parse_price(latest["blsell"]),
+                    parse_price(latest["diff"])
+                )
+    except Exception as e:
+        print(f"Error fetching gold price: {e}")
+    return None
+
+def get_gold_price():
+    """Return the latest gold price, reusing a fetched result for GOLD_PRICE_TTL seconds.
+
+    Only one thread fetches at a time and the lock is not held during the
+    request. While a refresh is running, other callers get the previous quote,
+    or wait for the fetch if there is none yet. A failed fetch keeps the
+    previous quote and postpones the next attempt by GOLD_PRICE_FAILURE_TTL.
+    """
+    with _gold_cond:
+        while True:
+            if _gold_cache["expires"] is not None and time.monotonic() < _gold_cache["expires"]:
+                return _gold_cache["val"]
+            if not _gold_cache["refreshing"]:
+                _gold_cache["refreshing"] = True
+                break
+            if _gold_cache["val"] is not None:
+                return _gold_cache["val"]
+            _gold_cond.wait()
+    gold_data = None
+    try:
+        gold_data = fetch_gold_price()
+    finally:
+        with _gold_cond:
+            if gold_data is not None:
+                _gold_cache["val"] = gold_data
+                _gold_cache["expires"] = time.monotonic() + GOLD_PRICE_TTL
+            else:
+                _gold_cache["expires"] = time.monotonic() + GOLD_PRICE_FAILURE_TTL
+            _gold_cache["refreshing"] = False
+            _gold_cond.notify_all()
+            current = _gold_cache["val"]
+    return current
+
+def format_gold_message(gold_data):
+    """Format gold price data into a readable message"""
+    return _format_gold(gold_data) if gold_data else GOLD_ERROR_MESSAGE
@@ -0,0 +1,11 @@
+import multiprocessing
+import os
+
+# One process per core, several request threads each
+bind = os.getenv('BIND', '0.0.0.0:5000')
+worker_class = 'gthread'
+workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+threads = int(os.getenv('GUNICORN_THREADS', 8))
+
+# Pools are per worker; one reader per thread plus the writer connection
+os.environ.setdefault('DB_POOL_SIZE', str(threads + 1))
@@ -0,0 +1,9 @@
+"""Run the gold price change notifier for the app2 bot as its own process.
+
+Web workers must not start the scheduler themselves, otherwise every
+worker would push the same notification.
+"""
+from app2 import start_scheduler
+
+if __name__ == "__main__":
+    start_scheduler().join()
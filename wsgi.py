@@ -0,0 +1,4 @@
+"""WSGI entry point for the message history bot (app.py) under gunicorn"""
+from app import app
+
+application = app
@@ -0,0 +1,4 @@
+"""WSGI entry point for the gold price subscription bot (app2.py) under gunicorn"""
+from app2 import app
+
+application = app